@@ -1,64 +1,143 @@
 # api_server_fixed.py
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, ORJSONResponse
+from anyio import to_thread
+from pydantic import BaseModel, ConfigDict
 from typing import Optional
+from collections import defaultdict, deque
+import asyncio
 import datetime
+import itertools
 import json
+import logging
+import os
 
-app = FastAPI(title="AI Fitness Advisor API", 
-              description="API for personalized workout recommendations",
-              version="1.0.0")
+from batcher import DynBatcher
+
+logger = logging.getLogger(__name__)
 
-# Import the simple advisor (no API key needed)
 try:
-    from fitness_advisor import SimpleFitnessAdvisor
-    advisor = SimpleFitnessAdvisor()
-    print("✅ Using SimpleFitnessAdvisor (no API key needed)")
+    # Encode responses with orjson when it's installed, like fitness_advisor does for parsing
+    import orjson  # noqa: F401
+    DEFAULT_RESPONSE_CLASS = ORJSONResponse
 except ImportError:
-    # Create a fallback advisimple_fitness_advisor.py doesn't exist
-    print("⚠️  Creating fallback advisor...")
+    DEFAULT_RESPONSE_CLASS = JSONResponse
+
+# Max advisor calls running at once in the worker threadpool
+ADVISOR_THREAD_LIMIT = 64
+
+# Concurrent AI requests are grouped into one DeepSeek call of up to this many,
+# waiting at most BATCH_MAX_DELAY seconds for the batch to fill
+BATCH_MAX_SIZE = 8
+BATCH_MAX_DELAY = 0.05
+
+# Set to serve AI recommendations from DeepSeek instead of the rule-based advisor
+DEEPSEEK_API_KEY = os.environ.get("DEEPSEEK_API_KEY")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Advisor calls block on the LLM, so allow more of them in flight than anyio's default of 40
+    to_thread.current_default_thread_limiter().total_tokens = ADVISOR_THREAD_LIMIT
+    
+    app.state.client = None
+    app.state.batcher = None
+    if DEEPSEEK_API_KEY:
+        import httpx
+        from openai import AsyncOpenAI
+        from fitness_advisor import DEEPSEEK_BASE_URL
+        # One pooled client per worker so connections are kept alive between requests
+        app.state.client = AsyncOpenAI(
+            api_key=DEEPSEEK_API_KEY,
+            base_url=DEEPSEEK_BASE_URL,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=100)
+            )
+        )
+        advisor.async_client = app.state.client
+        app.state.batcher = DynBatcher(
+            advisor.analyze_health_status_batch_async,
+            max_batch_size=BATCH_MAX_SIZE,
+            max_delay=BATCH_MAX_DELAY
+        )
+        await app.state.batcher.start()
+    
+    yield
     
-    class FallbackAdvisor:
-        def analyze_health_status(self, heart_rate, sleep_hours, stress_level, previous_workout=None):
-            # Simple rule-based logic
-            if heart_rate > 100 or sleep_hours < 4 or stress_level >= 8:
-                return {
-                    "alert_level": "high",
-                    "should_train": False,
-                    "workout": "Rest day",
-                    "intensity": "very low",
-                    "duration": 0,
-                    "message": "Rest recommended based on your metrics",
-                    "modifications": "Focus on recovery",
-                    "recovery_tips": "Hydrate and get good sleep"
-                }
-            elif heart_rate > 85 or sleep_hours < 6 or stress_level >= 6:
-                return {
-                    "alert_level": "medium",
-                    "should_train": True,
-                    "workout": "Light cardio (walking, cycling)",
-                    "intensity": "low",
-                    "duration": 30,
-                    "message": "Light activity recommended",
-                    "modifications": "Reduce intensity if needed",
-                    "recovery_tips": "Listen to your body"
-                }
-            else:
-                return {
-                    "alert_level": "low",
-                    "should_train": True,
-                    "workout": "Moderate workout",
-                    "intensity": "moderate",
-                    "duration": 45,
-                    "message": "Good condition for training",
-                    "modifications": "None needed",
-                    "recovery_tips": "Stay hydrated"
-                }
+    if app.state.batcher is not None:
+        await app.state.batcher.stop()
+    if app.state.client is not None:
+        advisor.async_client = None
+        await app.state.client.close()
+
+app = FastAPI(title="AI Fitness Advisor API", 
+              description="API for personalized workout recommendations",
+              version="1.0.0",
+              lifespan=lifespan,
+              default_response_class=DEFAULT_RESPONSE_CLASS)
+
+if DEEPSEEK_API_KEY:
+    from fitness_advisor import FitnessAdvisorAgent
+    advisor = FitnessAdvisorAgent(api_key=DEEPSEEK_API_KEY)
+    print("✅ Using FitnessAdvisorAgent (DeepSeek API)")
+else:
+    # Import the simple advisor (no API key needed)
+    try:
+        from fitness_advisor import SimpleFitnessAdvisor
+        advisor = SimpleFitnessAdvisor()
+        print("✅ Using SimpleFitnessAdvisor (no API key needed)")
+    except ImportError:
+        # Create a fallback advisimple_fitness_advisor.py doesn't exist
+        print("⚠️  Creating fallback advisor...")
+        from fitness_advisor import _classify_metrics
+    
+        _FALLBACK_TEMPLATES = (
+            {
+                "alert_level": "high",
+                "should_train": False,
+                "workout": "Rest day",
+                "intensity": "very low",
+                "duration": 0,
+                "message": "Rest recommended based on your metrics",
+                "modifications": "Focus on recovery",
+                "recovery_tips": "Hydrate and get good sleep"
+            },
+            {
+                "alert_level": "medium",
+                "should_train": True,
+                "workout": "Light cardio (walking, cycling)",
+                "intensity": "low",
+                "duration": 30,
+                "message": "Light activity recommended",
+                "modifications": "Reduce intensity if needed",
+                "recovery_tips": "Listen to your body"
+            },
+            {
+                "alert_level": "low",
+                "should_train": True,
+                "workout": "Moderate workout",
+                "intensity": "moderate",
+                "duration": 45,
+                "message": "Good condition for training",
+                "modifications": "None needed",
+                "recovery_tips": "Stay hydrated"
+            },
+        )
+    
+        class FallbackAdvisor:
+            def analyze_health_status(self, heart_rate, sleep_hours, stress_level, previous_workout=None):
+                # Simple rule-based logic, same thresholds as FitnessAdvisorAgent's fallback.
+                # Copy so callers can add metadata without touching the template
+                return {**_FALLBACK_TEMPLATES[_classify_metrics(heart_rate, sleep_hours, stress_level)]}
     
-    advisor = FallbackAdvisor()
+        advisor = FallbackAdvisor()
 
 # Request models
 class HealthMetrics(BaseModel):
+    # Immutable once validated, so it can be shared safely between concurrent tasks
+    model_config = ConfigDict(frozen=True)
+    
     heart_rate: int
     sleep_hours: float
     stress_level: int
@@ -67,28 +146,92 @@ class HealthMetrics(BaseModel):
     age: Optional[int] = None
     fitness_level: Optional[str] = "intermediate"
 
+# Static parts of the health check responses, built once at import time
+if DEEPSEEK_API_KEY:
+    _API_VERSION_LABEL = "DeepSeek Version"
+    _ADVISOR_NAME = "FitnessAdvisorAgent"
+    _ADVISOR_TYPE = "FitnessAdvisorAgent (DeepSeek API)"
+else:
+    _API_VERSION_LABEL = "Simple Version"
+    _ADVISOR_NAME = "SimpleFitnessAdvisor"
+    _ADVISOR_TYPE = "SimpleFitnessAdvisor (No API Key Needed)"
+
+_ROOT_PAYLOAD = {
+    "message": f"AI Fitness Advisor API - {_API_VERSION_LABEL}",
+    "status": "active",
+    "advisor_type": _ADVISOR_TYPE,
+    "endpoints": {
+        "health_check": "/health",
+        "get_recommendation": "/recommend",
+        "batch_recommendations": "/batch"
+    }
+}
+
+_HEALTH_STATIC = {
+    "status": "healthy",
+    "advisor": _ADVISOR_NAME,
+    "version": "1.0.0"
+}
+
 # Health check endpoint
 @app.get("/")
 async def root():
-    return {
-        "message": "AI Fitness Advisor API - Simple Version",
-        "status": "active",
-        "advisor_type": "SimpleFitnessAdvisor (No API Key Needed)",
-        "endpoints": {
-            "health_check": "/health",
-            "get_recommendation": "/recommend",
-            "batch_recommendations": "/batch"
-        }
-    }
+    return _ROOT_PAYLOAD
 
 @app.get("/health")
 async def health_check():
-    return {
-        "status": "healthy",
-        "timestamp": datetime.datetime.now().isoformat(),
-        "advisor": "SimpleFitnessAdvisor",
-        "version": "1.0.0"
-    }
+    payload = {**_HEALTH_STATIC, "timestamp": datetime.datetime.now().isoformat()}
+    if DEEPSEEK_API_KEY:
+        # Recommendation cache hit/miss counters for this worker
+        payload["cache"] = advisor.cache_info()
+    return payload
+
+# Advisor calls currently running, keyed by their inputs, so identical
+# concurrent requests share one call instead of each hitting the advisor
+_inflight: dict[tuple, asyncio.Future] = {}
+
+# FitnessAdvisorAgent key -> API response key
+_AGENT_FIELD_NAMES = {
+    "recommended_workout": "workout",
+    "intensity_level": "intensity",
+    "duration_minutes": "duration",
+    "alert_message": "message"
+}
+
+def _to_api_fields(result: dict) -> dict:
+    """Rename FitnessAdvisorAgent keys to the ones the API responds with"""
+    return {_AGENT_FIELD_NAMES.get(key, key): value for key, value in result.items()}
+
+async def _analyze(metrics: HealthMetrics) -> dict:
+    # Share a batched AI call with other requests when the batcher is running,
+    # else run the advisor in the threadpool
+    batcher = getattr(app.state, "batcher", None)
+    if batcher is not None:
+        return _to_api_fields(await batcher.process_batched(
+            (metrics.heart_rate, metrics.sleep_hours, metrics.stress_level, metrics.previous_workout)
+        ))
+    result = await run_in_threadpool(
+        advisor.analyze_health_status,
+        heart_rate=metrics.heart_rate,
+        sleep_hours=metrics.sleep_hours,
+        stress_level=metrics.stress_level,
+        previous_workout=metrics.previous_workout
+    )
+    return _to_api_fields(result) if DEEPSEEK_API_KEY else result
+
+async def _analyze_single_flight(metrics: HealthMetrics) -> dict:
+    key = (metrics.heart_rate, metrics.sleep_hours, metrics.stress_level, metrics.previous_workout)
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_analyze(metrics))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # Shield so one client disconnecting doesn't cancel the call for the others,
+    # and copy since every caller adds its own metadata to the result
+    return dict(await asyncio.shield(task))
+
+# Fields every /recommend response must have, "N/A" when the advisor left them out
+_REQUIRED_FIELDS = ("alert_level", "should_train", "workout", "intensity", "duration")
 
 # Main recommendation endpoint
 @app.post("/recommend")
@@ -106,40 +249,31 @@ async def get_recommendation(metrics: HealthMetrics):
     }
     """
     try:
-        print(f"📊 Received metrics: HR={metrics.heart_rate}, Sleep={metrics.sleep_hours}, Stress={metrics.stress_level}")
+        logger.debug("Received metrics: HR=%s, Sleep=%s, Stress=%s",
+                     metrics.heart_rate, metrics.sleep_hours, metrics.stress_level)
         
-        result = advisor.analyze_health_status(
-            heart_rate=metrics.heart_rate,
-            sleep_hours=metrics.sleep_hours,
-            stress_level=metrics.stress_level,
-            previous_workout=metrics.previous_workout
-        )
+        result = await _analyze_single_flight(metrics)
         
         # Ensure all required fields exist
-        required_fields = ["alert_level", "should_train", "workout", "intensity", "duration"]
-        for field in required_fields:
-            if field not in result:
-                result[field] = "N/A"
+        for field in _REQUIRED_FIELDS:
+            result.setdefault(field, "N/A")
         
         # Add metadata
-        result["api_version"] = "1.0"
-        result["timestamp"] = datetime.datetime.now().isoformat()
-        result["request_id"] = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        result["user_id"] = metrics.user_id
-        result["input_metrics"] = {
-            "heart_rate": metrics.heart_rate,
-            "sleep_hours": metrics.sleep_hours,
-            "stress_level": metrics.stress_level,
-            "previous_workout": metrics.previous_workout,
-            "age": metrics.age,
-            "fitness_level": metrics.fitness_level
+        now = datetime.datetime.now()
+        result |= {
+            "api_version": "1.0",
+            "timestamp": now.isoformat(),
+            "request_id": now.strftime("%Y%m%d%H%M%S"),
+            "user_id": metrics.user_id,
+            "input_metrics": metrics.model_dump(exclude={"user_id"})
         }
         
-        print(f"✅ Generated recommendation: {result['alert_level']} alert, Train: {result['should_train']}")
+        logger.debug("Generated recommendation: %s alert, Train: %s",
+                     result['alert_level'], result['should_train'])
         return result
         
     except Exception as e:
-        print(f"❌ Error: {e}")
+        logger.exception("Recommendation failed: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # Batch processing endpoint
@@ -148,35 +282,41 @@ async def batch_recommendations(metrics_list: list[HealthMetrics]):
     """
     Process multiple recommendations at once
     """
+    # Run every item at once; failures come back as exceptions
+    raw_results = await asyncio.gather(
+        *[_analyze(metrics) for metrics in metrics_list],
+        return_exceptions=True
+    )
+    
+    now = datetime.datetime.now()
+    now_iso = now.isoformat()
+    
     results = []
-    for metrics in metrics_list:
-        try:
-            result = advisor.analyze_health_status(
-                heart_rate=metrics.heart_rate,
-                sleep_hours=metrics.sleep_hours,
-                stress_level=metrics.stress_level,
-                previous_workout=metrics.previous_workout
-            )
-            
-            # Add metadata
-            result["user_id"] = metrics.user_id
-            result["request_timestamp"] = datetime.datetime.now().isoformat()
-            results.append(result)
-            
-        except Exception as e:
+    successful = 0
+    failed = 0
+    for metrics, result in zip(metrics_list, raw_results):
+        if isinstance(result, Exception):
+            failed += 1
             results.append({
-                "error": str(e),
+                "error": str(result),
                 "user_id": metrics.user_id,
                 "heart_rate": metrics.heart_rate,
                 "sleep_hours": metrics.sleep_hours,
                 "stress_level": metrics.stress_level
             })
+            continue
+        
+        # Add metadata
+        result["user_id"] = metrics.user_id
+        result["request_timestamp"] = now_iso
+        results.append(result)
+        successful += 1
     
     return {
-        "batch_id": datetime.datetime.now().strftime("%Y%m%d%H%M%S"),
+        "batch_id": now.strftime("%Y%m%d%H%M%S"),
         "total_requests": len(metrics_list),
-        "successful": len([r for r in results if "error" not in r]),
-        "failed": len([r for r in results if "error" in r]),
+        "successful": successful,
+        "failed": failed,
         "results": results
     }
 
@@ -192,50 +332,66 @@ async def test_endpoint():
         user_id="test_user"
     )
     
-    result = advisor.analyze_health_status(
-        heart_rate=test_metrics.heart_rate,
-        sleep_hours=test_metrics.sleep_hours,
-        stress_level=test_metrics.stress_level,
-        previous_workout=test_metrics.previous_workout
-    )
+    result = await _analyze(test_metrics)
     
     return {
         "test": "successful",
-        "sample_data": test_metrics.dict(),
+        "sample_data": test_metrics.model_dump(),
         "recommendation": result
     }
 
-# Simple history storage (in memory for demo)
-workout_history = []
+# Simple history storage (in memory for demo), capped so it can't grow forever
+HISTORY_MAX_ENTRIES = 10000
+workout_history = deque(maxlen=HISTORY_MAX_ENTRIES)
+_history_by_user = defaultdict(deque)
+_history_ids = itertools.count(1)
 
 @app.post("/history")
 async def save_to_history(metrics: HealthMetrics, recommendation: dict):
     """Save recommendation to history"""
     entry = {
-        "id": len(workout_history) + 1,
+        "id": next(_history_ids),
         "timestamp": datetime.datetime.now().isoformat(),
         "user_id": metrics.user_id or "anonymous",
-        "metrics": metrics.dict(),
+        "metrics": metrics.model_dump(),
         "recommendation": recommendation
     }
+    if len(workout_history) == workout_history.maxlen:
+        # The oldest entry is about to be evicted, drop it from its user's index too
+        evicted = workout_history[0]
+        user_entries = _history_by_user[evicted["user_id"]]
+        user_entries.popleft()
+        if not user_entries:
+            del _history_by_user[evicted["user_id"]]
     workout_history.append(entry)
+    _history_by_user[entry["user_id"]].append(entry)
     return {"status": "saved", "entry_id": entry["id"]}
 
 @app.get("/history")
-async def get_history(user_id: Optional[str] = None):
-    """Get workout history"""
+async def get_history(user_id: Optional[str] = None,
+                      limit: int = Query(100, ge=1),
+                      offset: int = Query(0, ge=0)):
+    """Get workout history, newest first, one page of up to `limit` entries"""
     if user_id:
-        user_history = [h for h in workout_history if h.get("user_id") == user_id]
-        return {"user_id": user_id, "entries": user_history}
-    return {"total_entries": len(workout_history), "entries": workout_history}
+        user_history = _history_by_user.get(user_id, ())
+        entries = list(itertools.islice(reversed(user_history), offset, offset + limit))
+        return {"user_id": user_id, "entries": entries}
+    entries = list(itertools.islice(reversed(workout_history), offset, offset + limit))
+    return {"total_entries": len(workout_history), "entries": entries}
 
 if __name__ == "__main__":
     import uvicorn
     print("\n" + "="*50)
     print("🚀 STARTING FITNESS ADVISOR API")
     print("="*50)
-    print("Version: Simple (No API Key Needed)")
+    print(f"Version: {_API_VERSION_LABEL} ({_ADVISOR_TYPE})")
+    # Worker count and auto-reload come from the environment; reload is for development only.
+    # History and caches live in each process's memory, so only raise WEB_CONCURRENCY
+    # (e.g. to 2 * CPUs + 1) if clients don't rely on /history across requests
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    reload = os.environ.get("RELOAD") == "1"
     print("Port: 8000")
+    print(f"Workers: {1 if reload else workers}{' (auto-reload)' if reload else ''}")
     print("\n📚 API Documentation:")
     print("  • Swagger UI: http://localhost:8000/docs")
     print("  • ReDoc:      http://localhost:8000/redoc")
@@ -244,4 +400,5 @@ if __name__ == "__main__":
     print("  • Test:       http://localhost:8000/test")
     print("="*50 + "\n")
     
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    # Pass the app as an import string so uvicorn can start several worker processes
+    uvicorn.run("api_server:app", host="0.0.0.0", port=8000, workers=workers, reload=reload)
\ No newline at end of file
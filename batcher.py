@@ -0,0 +1,93 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Iterable, List, Optional
+
+
+class DynBatcher:
+    """Collects concurrent requests and hands them to a single batch call.
+
+    A batch is dispatched as soon as max_batch_size items are waiting, or
+    max_delay seconds after its first item arrived, whichever comes first.
+    process_batch must return one result per item, in the same order.
+    """
+
+    def __init__(self, process_batch: Callable[[List[Any]], Awaitable[List[Any]]],
+                 max_batch_size: int = 8, max_delay: float = 0.05):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._collector: Optional[asyncio.Task] = None
+        self._dispatches = set()
+
+    async def start(self):
+        """Start collecting batches on the running event loop"""
+        self._queue = asyncio.Queue()
+        self._collector = asyncio.create_task(self._collect())
+
+    async def stop(self):
+        """Stop collecting, cancel any batch still in flight and fail every waiting caller"""
+        tasks = [self._collector, *self._dispatches]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Items queued but never collected into a batch
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            self._fail([future])
+
+    async def process_batched(self, item: Any) -> Any:
+        """Queue an item and wait for its result from the next batch"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                deadline = loop.time() + self.max_delay
+                while len(batch) < self.max_batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                # Dispatch in the background so the next batch can be collected meanwhile
+                task = asyncio.create_task(self._dispatch(batch))
+                self._dispatches.add(task)
+                task.add_done_callback(self._dispatches.discard)
+                batch = []
+        except asyncio.CancelledError:
+            # Stopped while a batch was being collected
+            self._fail(future for _, future in batch)
+            raise
+
+    async def _dispatch(self, batch: List[tuple]):
+        try:
+            results = await self.process_batch([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"Expected {len(batch)} batch results, got {len(results)}")
+        except asyncio.CancelledError:
+            self._fail(future for _, future in batch)
+            raise
+        except Exception as e:
+            self._fail((future for _, future in batch), e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            # The caller may have given up (e.g. client disconnected) in the meantime
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    def _fail(futures: Iterable[asyncio.Future], error: Optional[Exception] = None):
+        """Resolve still-pending futures with error, or a "batcher stopped" error"""
+        for future in futures:
+            if not future.done():
+                future.set_exception(error or RuntimeError("Batcher stopped before the request was processed"))
@@ -1,163 +1,408 @@
+import asyncio
 import json
-from typing import Dict, List, Optional
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 import datetime
+import logging
+import threading
+
+try:
+    # orjson is much faster than the json module; its decode error subclasses json.JSONDecodeError
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+logger = logging.getLogger(__name__)
+
+DEEPSEEK_BASE_URL = "https://api.deepseek.com"
+
+# System prompt to guide the AI's behavior
+_SYSTEM_PROMPT = """You are an expert fitness and health advisor AI. Your role is to analyze 
+user's health metrics (heart rate, sleep, stress) and provide personalized workout 
+recommendations and safety alerts.
+
+Always follow these guidelines:
+1. Prioritize user safety and health
+2. Consider all metrics together, not individually
+3. Provide specific, actionable recommendations
+4. Explain your reasoning clearly
+5. Suggest modifications for different fitness levels
+
+Format your response as JSON with these keys:
+- alert_level: "high", "medium", "low", or "rest"
+- should_train: true or false
+- alert_message: Brief explanation of the alert
+- recommended_workout: Specific workout plan
+- intensity_level: "low", "moderate", or "high"
+- duration_minutes: Recommended workout duration
+- modifications: Optional modifications or alternatives
+- recovery_tips: Tips for recovery if needed
+
+Base your recommendations on medical guidelines:
+- Resting HR > 100 bpm: Consider rest
+- Sleep < 6 hours: Reduce intensity
+- Stress > 7/10: Prefer light activity or rest
+"""
+
+# User prompt, filled in by FitnessAdvisorAgent._create_prompt
+_USER_PROMPT_TEMPLATE = """Analyze these health metrics and provide workout recommendations:
+
+Current Health Status:
+- Resting Heart Rate: {heart_rate} bpm
+- Sleep Duration: {sleep_hours} hours
+- Stress Level: {stress_level}/10
+
+Additional Context:
+- Previous Workout: {previous_workout}
+- Current Time: {now}
+
+Please provide your analysis and recommendations in the specified JSON format."""
+
+# User prompt for several sets of metrics answered by one AI call
+_BATCH_PROMPT_TEMPLATE = """Analyze each of these {count} sets of health metrics and provide workout recommendations for each one:
+
+{entries}
+
+Additional Context:
+- Current Time: {now}
+
+Reply with a JSON array of exactly {count} objects in the specified JSON format, one per set and in the same order."""
+
+_BATCH_ENTRY_TEMPLATE = """Set {number}:
+- Resting Heart Rate: {heart_rate} bpm
+- Sleep Duration: {sleep_hours} hours
+- Stress Level: {stress_level}/10
+- Previous Workout: {previous_workout}"""
+
+# Rule-based recommendations used when the AI is unavailable, indexed by _classify_metrics()
+_FALLBACK_TEMPLATES = (
+    {
+        "alert_level": "high",
+        "should_train": False,
+        "recommended_workout": "Rest day or gentle stretching",
+        "intensity_level": "very low",
+        "duration_minutes": 15,
+    },
+    {
+        "alert_level": "medium",
+        "should_train": True,
+        "recommended_workout": "Light cardio (walking, cycling)",
+        "intensity_level": "low",
+        "duration_minutes": 30,
+    },
+    {
+        "alert_level": "low",
+        "should_train": True,
+        "recommended_workout": "Moderate workout (running, weight training)",
+        "intensity_level": "moderate",
+        "duration_minutes": 45,
+    },
+)
+
+# Used when the AI replies without any JSON in its response
+_FORMAT_ISSUE_RECOMMENDATION = {
+    "alert_level": "medium",
+    "should_train": True,
+    "alert_message": "AI response format issue, using default recommendation",
+    "recommended_workout": "Light cardio (30 min walk/jog)",
+    "intensity_level": "low",
+    "duration_minutes": 30,
+    "modifications": "Reduce intensity if feeling tired",
+    "recovery_tips": "Stay hydrated and monitor how you feel"
+}
+
+
+def _classify_metrics(heart_rate: int, sleep_hours: float, stress_level: int) -> int:
+    """Return 0 for rest, 1 for light activity, 2 for a normal workout"""
+    if heart_rate > 100 or sleep_hours < 4 or stress_level >= 8:
+        return 0
+    if heart_rate > 85 or sleep_hours < 6 or stress_level >= 6:
+        return 1
+    return 2
+
 
 class FitnessAdvisorAgent:
-    def __init__(self, api_key: str, model: str = "deepseek-chat"):
+    def __init__(self, api_key: str, model: str = "deepseek-chat", cache_size: int = 1024,
+                 async_client=None):
         
         try:
             from openai import OpenAI
             self.client = OpenAI(
                 api_key=api_key,
-                base_url="https://api.deepseek.com"
+                base_url=DEEPSEEK_BASE_URL
             )
             self.model = model
         except ImportError:
             raise ImportError("Please install openai package: pip install openai")
+        
+        # Optional openai.AsyncOpenAI used by analyze_health_status_batch_async
+        self.async_client = async_client
+        
+        # LRU cache of AI recommendations keyed by bucketed metrics
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
     
     def analyze_health_status(self, heart_rate: int, sleep_hours: float, 
                             stress_level: int, previous_workout: str = None) -> Dict:
         
-        
-        # Prepare the prompt for the AI
-        prompt = self._create_prompt(heart_rate, sleep_hours, stress_level, previous_workout)
+        cache_key = self._cache_key(heart_rate, sleep_hours, stress_level, previous_workout)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return self._with_input_metrics(cached, heart_rate, sleep_hours, stress_level)
         
         try:
             response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": self._get_system_prompt()},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=500
+                **self._completion_request(heart_rate, sleep_hours, stress_level, previous_workout)
             )
-            
-            ai_response = response.choices[0].message.content
-            
+        except Exception as e:
+            logger.warning("Error calling DeepSeek API: %s", e)
+            return self._get_fallback_recommendation(heart_rate, sleep_hours, stress_level)
+        
+        payload = self._payload_from_response(cache_key, response)
+        return self._recommendation_for(payload, heart_rate, sleep_hours, stress_level)
+    
+    async def analyze_health_status_batch_async(self, metrics_list: List[Tuple]) -> List[Dict]:
+        """Analyze several (heart_rate, sleep_hours, stress_level, previous_workout)
+        tuples with a single AI call through self.async_client"""
+        
+        results = [None] * len(metrics_list)
+        # Indexes of the cache misses, grouped by cache key so each bucket is only asked for once
+        misses = {}
+        for i, metrics in enumerate(metrics_list):
+            cache_key = self._cache_key(*metrics)
+            cached = self._cache_get(cache_key)
+            if cached is not None:
+                results[i] = self._with_input_metrics(cached, *metrics[:3])
+            else:
+                misses.setdefault(cache_key, []).append(i)
+        
+        if not misses:
+            return results
+        
+        cache_keys = list(misses)
+        pending = [metrics_list[misses[cache_key][0]] for cache_key in cache_keys]
+        if len(pending) == 1:
+            payloads = [await self._request_payload_async(cache_keys[0], *pending[0])]
+        else:
+            payloads = await self._request_batch_payloads_async(cache_keys, pending)
+        
+        # Every request in a bucket shares the answer, with its own input metrics
+        for cache_key, payload in zip(cache_keys, payloads):
+            for i in misses[cache_key]:
+                results[i] = self._recommendation_for(payload, *metrics_list[i][:3])
+        return results
+    
+    async def _request_payload_async(self, cache_key: Tuple, heart_rate: int, sleep_hours: float, 
+                                     stress_level: int, previous_workout: str) -> Optional[Dict]:
+        """Ask the AI for one recommendation through self.async_client, after the cache has missed"""
+        
+        try:
+            response = await self.async_client.chat.completions.create(
+                **self._completion_request(heart_rate, sleep_hours, stress_level, previous_workout)
+            )
+        except Exception as e:
+            logger.warning("Error calling DeepSeek API: %s", e)
+            return None
+        
+        return self._payload_from_response(cache_key, response)
+    
+    async def _request_batch_payloads_async(self, cache_keys: List[Tuple], 
+                                            metrics_list: List[Tuple]) -> List[Optional[Dict]]:
+        """Ask the AI for several recommendations in one call through self.async_client"""
+        
+        try:
+            response = await self.async_client.chat.completions.create(
+                **self._batch_completion_request(metrics_list)
+            )
+            recommendations = self._parse_batch_response(response.choices[0].message.content, len(metrics_list))
+        except json.JSONDecodeError:
+            recommendations = None
+        except Exception as e:
+            logger.warning("Error calling DeepSeek API: %s", e)
+            return [None] * len(metrics_list)
+        
+        if recommendations is None:
+            # The reply didn't line up with the batch, ask for each set separately
+            return await asyncio.gather(
+                *[self._request_payload_async(cache_key, *metrics)
+                  for cache_key, metrics in zip(cache_keys, metrics_list)]
+            )
+        
+        for cache_key, recommendation in zip(cache_keys, recommendations):
+            self._cache_put(cache_key, recommendation)
+        return recommendations
+    
+    def _payload_from_response(self, cache_key: Tuple, response) -> Optional[Dict]:
+        """Recommendation (without input metrics) from a single-analysis chat completion,
+        None if the rule-based fallback should be used instead"""
+        
+        try:
             # Parse the AI response
-            return self._parse_response(ai_response, heart_rate, sleep_hours, stress_level)
-            
+            response_json = self._parse_response(response.choices[0].message.content)
+        except json.JSONDecodeError:
+            return None
         except Exception as e:
-            print(f"Error calling DeepSeek API: {e}")
+            logger.warning("Error calling DeepSeek API: %s", e)
+            return None
+        
+        if response_json is None:
+            # If no JSON found, use a structured default (not cached, the next call may do better)
+            return _FORMAT_ISSUE_RECOMMENDATION
+        self._cache_put(cache_key, response_json)
+        return response_json
+    
+    def _recommendation_for(self, payload: Optional[Dict], heart_rate: int, 
+                            sleep_hours: float, stress_level: int) -> Dict:
+        """Add the input metrics to an AI recommendation, or fall back to the rules for None"""
+        
+        if payload is None:
             return self._get_fallback_recommendation(heart_rate, sleep_hours, stress_level)
+        return self._with_input_metrics(payload, heart_rate, sleep_hours, stress_level)
     
-    def _get_system_prompt(self) -> str:
-        """System prompt to guide the AI's behavior"""
-        return """You are an expert fitness and health advisor AI. Your role is to analyze 
-        user's health metrics (heart rate, sleep, stress) and provide personalized workout 
-        recommendations and safety alerts.
+    def _completion_request(self, heart_rate: int, sleep_hours: float, 
+                            stress_level: int, previous_workout: str) -> Dict:
+        """Chat completion arguments for a health status analysis"""
+        
+        # Prepare the prompt for the AI
+        prompt = self._create_prompt(heart_rate, sleep_hours, stress_level, previous_workout)
         
-        Always follow these guidelines:
-        1. Prioritize user safety and health
-        2. Consider all metrics together, not individually
-        3. Provide specific, actionable recommendations
-        4. Explain your reasoning clearly
-        5. Suggest modifications for different fitness levels
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": self._get_system_prompt()},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.7,
+            "max_tokens": 500
+        }
+    
+    def _batch_completion_request(self, metrics_list: List[Tuple]) -> Dict:
+        """Chat completion arguments for analyzing several sets of metrics at once"""
         
-        Format your response as JSON with these keys:
-        - alert_level: "high", "medium", "low", or "rest"
-        - should_train: true or false
-        - alert_message: Brief explanation of the alert
-        - recommended_workout: Specific workout plan
-        - intensity_level: "low", "moderate", or "high"
-        - duration_minutes: Recommended workout duration
-        - modifications: Optional modifications or alternatives
-        - recovery_tips: Tips for recovery if needed
+        entries = "\n\n".join(
+            _BATCH_ENTRY_TEMPLATE.format(
+                number=number,
+                heart_rate=heart_rate,
+                sleep_hours=sleep_hours,
+                stress_level=stress_level,
+                previous_workout=previous_workout or 'No recent workout data'
+            )
+            for number, (heart_rate, sleep_hours, stress_level, previous_workout) in enumerate(metrics_list, 1)
+        )
+        prompt = _BATCH_PROMPT_TEMPLATE.format(
+            count=len(metrics_list),
+            entries=entries,
+            now=datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+        )
         
-        Base your recommendations on medical guidelines:
-        - Resting HR > 100 bpm: Consider rest
-        - Sleep < 6 hours: Reduce intensity
-        - Stress > 7/10: Prefer light activity or rest
-        """
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": self._get_system_prompt()},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.7,
+            "max_tokens": 500 * len(metrics_list)
+        }
+    
+    def cache_info(self) -> Dict:
+        """Hit/miss counters for the recommendation cache"""
+        with self._cache_lock:
+            return {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "size": len(self._cache),
+                "max_size": self.cache_size
+            }
+    
+    @staticmethod
+    def _cache_key(heart_rate: int, sleep_hours: float, 
+                   stress_level: int, previous_workout: Optional[str]) -> Tuple:
+        """Bucket the metrics so near-identical readings share a recommendation"""
+        return (heart_rate // 5, round(sleep_hours * 2) / 2, stress_level, previous_workout or "")
+    
+    def _cache_get(self, key: Tuple) -> Optional[Dict]:
+        with self._cache_lock:
+            payload = self._cache.get(key)
+            if payload is None:
+                self.cache_misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return payload
+    
+    def _cache_put(self, key: Tuple, payload: Dict):
+        with self._cache_lock:
+            self._cache[key] = payload
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+    
+    def _get_system_prompt(self) -> str:
+        """System prompt to guide the AI's behavior"""
+        return _SYSTEM_PROMPT
     
     def _create_prompt(self, heart_rate: int, sleep_hours: float, 
                       stress_level: int, previous_workout: str) -> str:
         """Create the user prompt with health metrics"""
+        return _USER_PROMPT_TEMPLATE.format(
+            heart_rate=heart_rate,
+            sleep_hours=sleep_hours,
+            stress_level=stress_level,
+            previous_workout=previous_workout or 'No recent workout data',
+            now=datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+        )
+    
+    def _parse_response(self, ai_response: str) -> Optional[Dict]:
+        """Extract the JSON recommendation from the AI response, None if there is none"""
         
-        prompt = f"""Analyze these health metrics and provide workout recommendations:
-        
-        Current Health Status:
-        - Resting Heart Rate: {heart_rate} bpm
-        - Sleep Duration: {sleep_hours} hours
-        - Stress Level: {stress_level}/10
+        json_start = ai_response.find('{')
+        json_end = ai_response.rfind('}') + 1
         
-        Additional Context:
-        - Previous Workout: {previous_workout if previous_workout else 'No recent workout data'}
-        - Current Time: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}
+        if json_start == -1 or json_end == 0:
+            return None
+        return _json_loads(ai_response[json_start:json_end])
+    
+    def _parse_batch_response(self, ai_response: str, count: int) -> Optional[List[Dict]]:
+        """Extract the JSON array of recommendations from a batch AI response,
+        None unless it holds exactly count recommendations"""
         
-        Please provide your analysis and recommendations in the specified JSON format."""
+        json_start = ai_response.find('[')
+        json_end = ai_response.rfind(']') + 1
         
-        return prompt
+        if json_start == -1 or json_end == 0:
+            return None
+        recommendations = _json_loads(ai_response[json_start:json_end])
+        if (not isinstance(recommendations, list) or len(recommendations) != count
+                or not all(isinstance(r, dict) for r in recommendations)):
+            return None
+        return recommendations
     
-    def _parse_response(self, ai_response: str, heart_rate: int, 
-                       sleep_hours: float, stress_level: int) -> Dict:
-        """Parse the AI response and add basic metrics"""
+    def _with_input_metrics(self, recommendation: Dict, heart_rate: int, 
+                            sleep_hours: float, stress_level: int) -> Dict:
+        """Copy the recommendation and add the original metrics to it"""
         
-        try:
-            # Extract JSON from the response
-            json_start = ai_response.find('{')
-            json_end = ai_response.rfind('}') + 1
-            
-            if json_start != -1 and json_end != 0:
-                response_json = json.loads(ai_response[json_start:json_end])
-            else:
-                # If no JSON found, create a structured response
-                response_json = {
-                    "alert_level": "medium",
-                    "should_train": True,
-                    "alert_message": "AI response format issue, using default recommendation",
-                    "recommended_workout": "Light cardio (30 min walk/jog)",
-                    "intensity_level": "low",
-                    "duration_minutes": 30,
-                    "modifications": "Reduce intensity if feeling tired",
-                    "recovery_tips": "Stay hydrated and monitor how you feel"
-                }
-            
-            # Add the original metrics to the response
-            response_json["input_metrics"] = {
+        return {
+            **recommendation,
+            "input_metrics": {
                 "heart_rate_bpm": heart_rate,
                 "sleep_hours": sleep_hours,
                 "stress_level": stress_level,
                 "timestamp": datetime.datetime.now().isoformat()
             }
-            
-            return response_json
-            
-        except json.JSONDecodeError:
-            return self._get_fallback_recommendation(heart_rate, sleep_hours, stress_level)
+        }
     
     def _get_fallback_recommendation(self, heart_rate: int, sleep_hours: float, 
                                    stress_level: int) -> Dict:
         """Provide fallback recommendations if AI fails"""
         
         # Basic rule-based recommendations
-        if heart_rate > 100 or sleep_hours < 4 or stress_level >= 8:
-            alert_level = "high"
-            should_train = False
-            workout = "Rest day or gentle stretching"
-            intensity = "very low"
-            duration = 15
-        elif heart_rate > 85 or sleep_hours < 6 or stress_level >= 6:
-            alert_level = "medium"
-            should_train = True
-            workout = "Light cardio (walking, cycling)"
-            intensity = "low"
-            duration = 30
-        else:
-            alert_level = "low"
-            should_train = True
-            workout = "Moderate workout (running, weight training)"
-            intensity = "moderate"
-            duration = 45
-        
         return {
-            "alert_level": alert_level,
-            "should_train": should_train,
+            **_FALLBACK_TEMPLATES[_classify_metrics(heart_rate, sleep_hours, stress_level)],
             "alert_message": f"Based on your metrics: HR={heart_rate}bpm, Sleep={sleep_hours}h, Stress={stress_level}/10",
-            "recommended_workout": workout,
-            "intensity_level": intensity,
-            "duration_minutes": duration,
             "modifications": "Listen to your body and adjust as needed",
             "recovery_tips": "Hydrate well and ensure proper nutrition",
             "input_metrics": {